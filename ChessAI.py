@@ -1,4 +1,5 @@
 import random
+import time
 
 piece_scores = {'K': 0, 'Q': 9, "R": 5, "B": 3, "N": 3, 'P': 1}
 
@@ -63,6 +64,20 @@ piece_position_scores = {"wP": pawn_scores_white, "bP": pawn_scores_black, "N":
 checkmate = 1000
 stalemate = 0
 max_depth = 2
+null_window = .01  # smaller than any difference in evaluation
+aspiration_window = .5
+
+# Search limits and statistics, set up by the helpers before each search
+search_depth = max_depth
+search_deadline = None
+search_stop = None
+search_root_ply = 0
+nodes = 0
+
+
+class SearchAborted(Exception):
+    pass
+
 
 '''
 Scoring functions
@@ -79,22 +94,21 @@ def score_board(gs):
         return stalemate
 
     score = 0
-    for row in range(len(gs.board)):
-        for col in range(len(gs.board[row])):
-            square = gs.board[row][col]
-            if square != '--':
-                piece_position_score = 0
-                # normalize this based on the piece type
-                if square[1] != 'K':
-                    if square[1] == 'P':
-                        piece_position_score = piece_position_scores[square][row][col]
-                    else:
-                        piece_position_score = piece_position_scores[square[1]][row][col]
-
-                if square[0] == 'w':
-                    score += (piece_scores[square[1]] + piece_position_score * .1)
-                elif square[0] == 'b':
-                    score -= (piece_scores[square[1]] + piece_position_score * .1)
+    for piece, squares in gs.piece_locations.items():
+        # Kings are worth nothing and have no position table
+        if piece[1] == 'K':
+            continue
+        # normalize this based on the piece type
+        if piece[1] == 'P':
+            position_scores = piece_position_scores[piece]
+        else:
+            position_scores = piece_position_scores[piece[1]]
+
+        for row, col in squares:
+            if piece[0] == 'w':
+                score += (piece_scores[piece[1]] + position_scores[row][col] * .1)
+            else:
+                score -= (piece_scores[piece[1]] + position_scores[row][col] * .1)
 
     return score
 
@@ -149,15 +163,24 @@ def min_max(gs, valid_moves, move_depth, white_turn):
 
 
 def nega_max_alphaBeta_helper(gs, valid_moves):
-    global next_move
+    global next_move, search_depth, search_deadline, search_stop, search_root_ply
     next_move = None
+    search_depth = max_depth
+    search_root_ply = len(gs.moveLog)
+    search_deadline = None
+    search_stop = None
 
     nega_max_alphaBeta(gs, valid_moves, max_depth, -checkmate, checkmate, 1 if gs.whiteToMove else -1)
     return next_move
 
 
 def nega_max_alphaBeta(gs, valid_moves, depth, alpha, beta,  multiplier):
-    global next_move
+    global next_move, nodes
+    nodes += 1
+    check_search_limits()
+
+    if depth != search_depth and is_search_draw(gs):
+        return stalemate
 
     if depth == 0:
         return score_board(gs) * multiplier
@@ -171,7 +194,7 @@ def nega_max_alphaBeta(gs, valid_moves, depth, alpha, beta,  multiplier):
         score = -nega_max_alphaBeta(gs, next_moves, depth - 1, -beta, -alpha, -multiplier)
         if score > max_score:
             max_score = score
-            if depth == max_depth:
+            if depth == search_depth:
                 next_move = move
         gs.undo_move()
         #pruning
@@ -180,4 +203,164 @@ def nega_max_alphaBeta(gs, valid_moves, depth, alpha, beta,  multiplier):
         if alpha >= beta:
             break
 
-    return max_score
\ No newline at end of file
+    return max_score
+
+
+def principal_variation_search_helper(gs, valid_moves):
+    global next_move, search_depth, search_deadline, search_stop, search_root_ply
+    search_depth = max_depth
+    search_root_ply = len(gs.moveLog)
+    search_deadline = None
+    search_stop = None
+
+    pv = []
+    principal_variation_search(gs, valid_moves, max_depth, -checkmate, checkmate, 1 if gs.whiteToMove else -1, pv)
+    next_move = pv[0] if len(pv) > 0 else None
+    return next_move
+
+
+def principal_variation_search(gs, valid_moves, depth, alpha, beta, multiplier, pv, pv_hint=()):
+    """
+    Nega max with alpha beta where only the first move gets the full window, the rest are searched with a null
+    window and re-searched on fail high. pv is filled with the best line from this node, pv_hint is the line of
+    the previous iteration which is searched first
+    """
+    global nodes
+    nodes += 1
+    check_search_limits()
+    del pv[:]
+
+    if depth != search_depth and is_search_draw(gs):
+        return stalemate
+
+    if depth == 0 or len(valid_moves) == 0:
+        return score_board(gs) * multiplier
+
+    child_hint = ()
+    if len(pv_hint) > 0 and pv_hint[0] in valid_moves:
+        valid_moves = [pv_hint[0]] + [move for move in valid_moves if move != pv_hint[0]]
+        child_hint = pv_hint[1:]
+
+    max_score = -checkmate
+    child_pv = []
+    for i, move in enumerate(valid_moves):
+        gs.make_move(move)
+        next_moves = gs.get_valid_moves()
+        if i == 0:
+            score = -principal_variation_search(gs, next_moves, depth - 1, -beta, -alpha, -multiplier, child_pv,
+                                                child_hint)
+        else:
+            # Only prove the move is no better than alpha, search it properly if that fails
+            score = -principal_variation_search(gs, next_moves, depth - 1, -alpha - null_window, -alpha,
+                                                -multiplier, child_pv)
+            if alpha < score < beta:
+                score = -principal_variation_search(gs, next_moves, depth - 1, -beta, -alpha, -multiplier, child_pv)
+        gs.undo_move()
+        if score > max_score:
+            max_score = score
+            pv[:] = [move] + child_pv
+        if max_score > alpha:
+            alpha = max_score
+        if alpha >= beta:
+            break
+
+    return max_score
+
+
+def is_search_draw(gs):
+    # Returning to any position since the root is a draw as the same moves can be played again, earlier history
+    # only counts once it makes a threefold repetition. gs.checkmate is already set for the node by the caller's
+    # get_valid_moves, a mate given on the hundredth halfmove still counts as a mate
+    if gs.checkmate:
+        return False
+    return gs.is_fifty_move_draw() or gs.repetition_count(search_root_ply) > 0 or gs.is_threefold_repetition()
+
+
+def check_search_limits():
+    if search_stop is not None and search_stop.is_set():
+        raise SearchAborted
+    if search_deadline is not None and time.time() > search_deadline:
+        raise SearchAborted
+
+
+'''
+Iterative deepening with time management, used by the headless UCI front end
+'''
+
+
+def iterative_deepening(gs, valid_moves, depth_limit=max_depth, time_limit=None, stop_event=None, on_iteration=None,
+                        use_pvs=True):
+    """
+    Search one ply deeper each iteration until the depth limit, the time limit (seconds) or the stop event is hit.
+    The best move and principal variation of the last completed iteration are returned,
+    on_iteration(depth, score, nodes, elapsed, pv) is called after every completed iteration with the score from
+    the side to move's perspective. With use_pvs the root searches aspiration windows around the previous score
+    """
+    global next_move, nodes, search_depth, search_deadline, search_stop, search_root_ply
+    if len(valid_moves) == 0:
+        return None, []
+
+    start = time.time()
+    nodes = 0
+    search_deadline = start + time_limit if time_limit is not None else None
+    search_stop = stop_event
+    ply = len(gs.moveLog)
+    search_root_ply = ply
+    multiplier = 1 if gs.whiteToMove else -1
+    best_move = valid_moves[0]
+    best_pv = [best_move]
+    score = 0
+    try:
+        for depth in range(1, depth_limit + 1):
+            # Search the best move of the previous iteration first so it is kept if the next one is cut short
+            ordered_moves = [best_move] + [move for move in valid_moves if move != best_move]
+            next_move = None
+            search_depth = depth
+            if use_pvs:
+                score, pv = aspiration_search(gs, ordered_moves, depth, score if depth > 1 else None, multiplier,
+                                              best_pv)
+                next_move = pv[0] if len(pv) > 0 else None
+            else:
+                score = nega_max_alphaBeta(gs, ordered_moves, depth, -checkmate, checkmate, multiplier)
+                pv = [next_move]
+            if next_move is not None:
+                best_move = next_move
+                best_pv = pv
+
+            elapsed = time.time() - start
+            if on_iteration is not None:
+                on_iteration(depth, score, nodes, elapsed, best_pv)
+            if abs(score) >= checkmate or len(valid_moves) == 1:
+                break
+            # Another iteration costs several times the last one, don't start one that can't finish
+            if time_limit is not None and elapsed > time_limit / 2:
+                break
+    except SearchAborted:
+        while len(gs.moveLog) > ply:
+            gs.undo_move()
+    finally:
+        search_deadline = None
+        search_stop = None
+
+    return best_move, best_pv
+
+
+def aspiration_search(gs, valid_moves, depth, previous_score, multiplier, pv_hint):
+    # Search a narrow window around the previous iteration's score, widening the side that fails until it holds
+    if previous_score is None or abs(previous_score) >= checkmate:
+        alpha, beta = -checkmate, checkmate
+    else:
+        alpha, beta = previous_score - aspiration_window, previous_score + aspiration_window
+
+    delta = aspiration_window
+    pv = []
+    while True:
+        score = principal_variation_search(gs, valid_moves, depth, alpha, beta, multiplier, pv, pv_hint)
+        if score <= alpha and alpha > -checkmate:
+            delta *= 2
+            alpha = max(score - delta, -checkmate)
+        elif score >= beta and beta < checkmate:
+            delta *= 2
+            beta = min(score + delta, checkmate)
+        else:
+            return score, pv
@@ -0,0 +1,265 @@
+"""
+Benchmark the engine over a fixed set of positions, save the results as JSON and compare them to a stored baseline
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import ChessEngine
+import ChessAI
+
+
+positions = {
+    "start": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "italian": "r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+    "kiwipete": "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "rook_endgame": "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "promotion": "n1n5/PPPk4/8/8/8/8/4Kppp/5N1N b - - 0 1",
+}
+
+default_repeat = 7
+default_depth = 2
+default_threshold = 0.25
+default_retries = 2
+min_sample_time = 0.05  # seconds, quick operations are looped until a sample takes at least this long
+default_output = "bench_results.json"
+default_baseline = "bench_baseline.json"
+
+
+'''
+Benchmarked operations, each runs on a position and its legal moves generated beforehand, leaves them as it
+found them so it can be repeated, and returns the number of nodes visited
+'''
+
+
+def load_position(fen):
+    gs = ChessEngine.GameState()
+    gs.load_fen(fen)
+    return gs
+
+
+def perft(gs, depth):
+    if depth == 0:
+        return 1
+    total = 0
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        total += perft(gs, depth - 1)
+        gs.undo_move()
+    return total
+
+
+def bench_get_valid_moves(gs, moves, depth):
+    # Clear the cache so every call generates the moves from scratch
+    gs.move_cache.clear()
+    return len(gs.get_valid_moves())
+
+
+def bench_make_undo(gs, moves, depth):
+    for move in moves:
+        gs.make_move(move)
+        gs.undo_move()
+    return len(moves)
+
+
+def bench_score_board(gs, moves, depth):
+    ChessAI.score_board(gs)
+    return 1
+
+
+def bench_perft(gs, moves, depth):
+    gs.move_cache.clear()
+    return perft(gs, depth)
+
+
+def bench_search(gs, moves, depth):
+    gs.move_cache.clear()
+    ChessAI.nodes = 0
+    ChessAI.search_depth = depth
+    ChessAI.search_root_ply = len(gs.moveLog)
+    valid_moves = gs.get_valid_moves()
+    ChessAI.nega_max_alphaBeta(gs, valid_moves, depth, -ChessAI.checkmate, ChessAI.checkmate,
+                               1 if gs.whiteToMove else -1)
+    return ChessAI.nodes
+
+
+benchmarks = {"get_valid_moves": bench_get_valid_moves, "make_undo_move": bench_make_undo,
+              "score_board": bench_score_board, "perft": bench_perft, "nega_max_alphaBeta": bench_search}
+
+
+'''
+Running and reporting
+'''
+
+
+def reference_work():
+    # Fixed pure Python work timed alongside every benchmark, timings are compared relative to it so a machine
+    # that is slower as a whole, for instance from other load, doesn't look like a regression
+    board = [["--"] * 8 for i in range(8)]
+    total = 0
+    for i in range(2000):
+        for row in board:
+            total += sum(1 for square in row if square == "--")
+    return total
+
+
+def time_loops(function, gs, moves, depth, loops):
+    start = time.perf_counter()
+    for i in range(loops):
+        function(gs, moves, depth)
+    return time.perf_counter() - start
+
+
+def time_benchmark(function, fen, depth, repeat):
+    # Like timeit.autorange, double the loop count until a sample is long enough to measure, then time repeat
+    # samples of that many calls. The times kept are per call
+    gs = load_position(fen)
+    moves = gs.get_valid_moves()
+    nodes = function(gs, moves, depth)
+    loops = 1
+    while time_loops(function, gs, moves, depth, loops) < min_sample_time:
+        loops *= 2
+    timings = []
+    references = []
+    for i in range(repeat):
+        timings.append(time_loops(function, gs, moves, depth, loops) / loops)
+        start = time.perf_counter()
+        reference_work()
+        references.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return {"median_ms": median * 1000, "min_ms": min(timings) * 1000, "max_ms": max(timings) * 1000,
+            "reference_ms": min(references) * 1000, "loops": loops, "nodes": nodes,
+            "nps": nodes / median if median > 0 else 0.0}
+
+
+def measure_peak_memory(depth):
+    # Run separately from the timings since tracing allocations slows everything down
+    tracemalloc.start()
+    for fen in positions.values():
+        for function in benchmarks.values():
+            gs = load_position(fen)
+            function(gs, gs.get_valid_moves(), depth)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def run_suite(depth=default_depth, repeat=default_repeat):
+    results = {}
+    for name, function in benchmarks.items():
+        results[name] = {}
+        for position, fen in positions.items():
+            results[name][position] = time_benchmark(function, fen, depth, repeat)
+
+    return {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "depth": depth,
+        "repeat": repeat,
+        "results": results,
+        "peak_memory_kb": measure_peak_memory(depth),
+    }
+
+
+def slowdown(result, old, threshold):
+    # Fraction the fastest sample is slower than the baseline's, the one least disturbed by the rest of the machine,
+    # scaled by the reference work timed with each. 0 unless it is over threshold and slower than every sample of
+    # the baseline, or when the baseline was saved before the reference work was timed
+    if old.get("reference_ms", 0) <= 0 or old["min_ms"] <= 0:
+        return 0.0
+    scaled = result["min_ms"] * old["reference_ms"] / result["reference_ms"]
+    change = scaled / old["min_ms"] - 1
+    return change if change > threshold and scaled > old["max_ms"] else 0.0
+
+
+def recheck(report, baseline, threshold, depth, repeat, retries=default_retries):
+    # Time every slow benchmark again, keeping the least slowed down run. A real regression is slow every time,
+    # a burst of other load on the machine isn't
+    for name, per_position in report["results"].items():
+        for position, result in per_position.items():
+            old = baseline.get("results", {}).get(name, {}).get(position)
+            for i in range(retries):
+                if old is None or slowdown(result, old, threshold) == 0:
+                    break
+                again = time_benchmark(benchmarks[name], positions[position], depth, repeat)
+                if again["min_ms"] / again["reference_ms"] < result["min_ms"] / result["reference_ms"]:
+                    result = per_position[position] = again
+
+
+def compare(report, baseline, threshold):
+    # Returns a line for every timing more than threshold slower than the baseline and every changed node count
+    regressions = []
+    for name, per_position in report["results"].items():
+        for position, result in per_position.items():
+            old = baseline.get("results", {}).get(name, {}).get(position)
+            if old is None:
+                continue
+            change = slowdown(result, old, threshold)
+            if change > 0:
+                regressions.append("%s/%s: %.3f ms -> %.3f ms (+%.0f%% allowing for machine speed)" %
+                                   (name, position, old["min_ms"], result["min_ms"], change * 100))
+            if result["nodes"] != old["nodes"]:
+                regressions.append("%s/%s: node count changed from %d to %d" %
+                                   (name, position, old["nodes"], result["nodes"]))
+    return regressions
+
+
+def print_report(report):
+    print("%-20s %-14s %12s %12s %10s %12s" % ("benchmark", "position", "median ms", "min ms", "nodes", "nodes/s"))
+    for name, per_position in report["results"].items():
+        for position, result in per_position.items():
+            print("%-20s %-14s %12.4f %12.4f %10d %12.0f" %
+                  (name, position, result["median_ms"], result["min_ms"], result["nodes"], result["nps"]))
+    print("peak memory %.0f KiB" % report["peak_memory_kb"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depth", type=int, default=default_depth, help="depth for perft and the search")
+    parser.add_argument("--repeat", type=int, default=default_repeat, help="timed samples per benchmark")
+    parser.add_argument("--output", default=default_output, help="where to write the results")
+    parser.add_argument("--baseline", default=default_baseline, help="results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=default_threshold,
+                        help="fraction a timing may be slower than the baseline before it is flagged")
+    parser.add_argument("--retries", type=int, default=default_retries,
+                        help="times a benchmark slower than the baseline is run again before it is flagged")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    report = run_suite(args.depth, args.repeat)
+    if baseline is not None:
+        recheck(report, baseline, args.threshold, args.depth, args.repeat, args.retries)
+    print_report(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("saved baseline to " + args.baseline)
+        return 0
+    if baseline is None:
+        print("no baseline at " + args.baseline + ", run with --save-baseline to create one")
+        return 0
+
+    regressions = compare(report, baseline, args.threshold)
+    for line in regressions:
+        print("REGRESSION " + line)
+    if len(regressions) == 0:
+        print("no regressions against " + args.baseline)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
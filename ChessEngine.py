@@ -2,6 +2,36 @@
 Store information about the current state of the chess game. Determines the valid moves at current state,
 and keeps a move log
 """
+import random
+import struct
+from collections import OrderedDict
+
+'''
+Zobrist keys, fixed seed so position hashes are the same between runs
+'''
+zobrist_random = random.Random(2021)
+zobrist_pieces = {color + piece: [[zobrist_random.getrandbits(64) for c in range(8)] for r in range(8)]
+                  for color in 'wb' for piece in 'PNBRQK'}
+zobrist_black_to_move = zobrist_random.getrandbits(64)
+zobrist_castling = [zobrist_random.getrandbits(64) for i in range(16)]
+zobrist_en_passant = [zobrist_random.getrandbits(64) for c in range(8)]
+
+move_cache_size = 4096
+
+'''
+Snapshot layout: 64 squares as 4 bit piece codes, flags (side to move and castling rights), en passant square,
+king squares and halfmove clock
+'''
+snapshot_format = struct.Struct("<32sBBBBB")
+snapshot_size = snapshot_format.size
+piece_codes = {"--": 0}
+piece_codes.update({color + piece: i + (1 if color == 'w' else 9) for color in 'wb' for i, piece in enumerate('PNBRQK')})
+code_pieces = {code: piece for piece, code in piece_codes.items()}
+# Both squares of a board byte at once
+byte_squares = [(code_pieces.get(byte >> 4), code_pieces.get(byte & 15)) for byte in range(256)]
+no_square = 255
+
+
 class GameState:
     def __init__(self):
         self.board = [
@@ -29,8 +59,152 @@ class GameState:
         self.checkmate = False
         self.stalemate = False
 
+        self.piece_locations = self.find_pieces()
+        self.key = self.compute_key()
+        self.key_log = [self.key]
+        self.move_cache = MoveCache(move_cache_size)
+        self.halfmove_clock = 0
+        self.halfmove_log = [self.halfmove_clock]
+
+    def load_fen(self, fen):
+        # Replace the current position with the one described by a FEN string, clearing the logs. Raises ValueError
+        # for anything that isn't an 8x8 board with one king per side and no pawns on the first or last rank, for
+        # castling rights without the king and rook on their home squares and for an en passant square without the
+        # pawn that just moved through it, leaving the current position untouched
+        fields = fen.split()
+        if len(fields) == 0:
+            raise ValueError("empty fen")
+        board = []
+        for rank in fields[0].split('/'):
+            row = []
+            for char in rank:
+                if char in "12345678":
+                    row.extend(["--"] * int(char))
+                elif char.upper() in "PNBRQK":
+                    row.append(('w' if char.isupper() else 'b') + char.upper())
+                else:
+                    raise ValueError("unknown piece " + char)
+            if len(row) != 8:
+                raise ValueError("rank without 8 squares")
+            board.append(row)
+        if len(board) != 8:
+            raise ValueError("board without 8 ranks")
+
+        kings = [(r, c) for r in range(8) for c in range(8) if board[r][c][1] == 'K']
+        white_kings = [square for square in kings if board[square[0]][square[1]] == 'wK']
+        if len(white_kings) != 1 or len(kings) != 2:
+            raise ValueError("each side needs exactly one king")
+        if any(piece[1] == 'P' for piece in board[0] + board[7]):
+            raise ValueError("pawn on the first or last rank")
+
+        if len(fields) > 1 and fields[1] not in ('w', 'b'):
+            raise ValueError("side to move must be w or b")
+        white_to_move = len(fields) < 2 or fields[1] == 'w'
+
+        rights = fields[2] if len(fields) > 2 else '-'
+        if rights != '-':
+            # Each right needs the king and the rook it castles with still on their starting squares
+            homes = {'K': (7, 'w', 7), 'Q': (7, 'w', 0), 'k': (0, 'b', 7), 'q': (0, 'b', 0)}
+            for right in rights:
+                if right not in homes:
+                    raise ValueError("unknown castling right " + right)
+                row, color, rook_col = homes[right]
+                if board[row][4] != color + 'K' or board[row][rook_col] != color + 'R':
+                    raise ValueError("castling right " + right + " without the king and rook at home")
+
+        en_passant = ()
+        if len(fields) > 3 and fields[3] != '-':
+            # The square behind a pawn of the side that just moved, which came from the square behind that
+            if len(fields[3]) != 2 or fields[3][0] not in Move.files_to_col or \
+                    fields[3][1] != ('6' if white_to_move else '3'):
+                raise ValueError("invalid en passant square")
+            r, c = Move.rank_to_rows[fields[3][1]], Move.files_to_col[fields[3][0]]
+            direction = 1 if white_to_move else -1
+            if board[r + direction][c] != ('b' if white_to_move else 'w') + 'P' or board[r][c] != "--" or \
+                    board[r - direction][c] != "--":
+                raise ValueError("en passant square without a pawn that just moved")
+            en_passant = (r, c)
+
+        halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        if halfmove_clock < 0:
+            raise ValueError("negative halfmove clock")
+
+        self.board = board
+        self.white_king = white_kings[0]
+        self.black_king = [square for square in kings if square != self.white_king][0]
+        self.whiteToMove = white_to_move
+        self.castling_ability = Castle('K' in rights, 'Q' in rights, 'k' in rights, 'q' in rights)
+        self.en_passant = en_passant
+        self._start_logs(halfmove_clock)
+
+    def pack(self):
+        # Fixed size binary snapshot of the position, without the move history
+        board = [piece_codes[piece] for row in self.board for piece in row]
+        squares = bytes([board[i] << 4 | board[i + 1] for i in range(0, 64, 2)])
+        flags = int(self.whiteToMove) | self.castling_ability.index() << 1
+        en_passant = self.en_passant[0] * 8 + self.en_passant[1] if self.en_passant != () else no_square
+        return snapshot_format.pack(squares, flags, en_passant, self.white_king[0] * 8 + self.white_king[1],
+                                    self.black_king[0] * 8 + self.black_king[1], min(self.halfmove_clock, 255))
+
+    def load_snapshot(self, data, offset=0):
+        # Replace the current position with a snapshot from pack, clearing the logs
+        squares, flags, en_passant, white_king, black_king, halfmove_clock = snapshot_format.unpack_from(data, offset)
+        self.board = []
+        for r in range(0, 32, 4):
+            row = []
+            for byte in squares[r:r + 4]:
+                row.extend(byte_squares[byte])
+            self.board.append(row)
+
+        self.whiteToMove = bool(flags & 1)
+        self.castling_ability = Castle(bool(flags & 2), bool(flags & 4), bool(flags & 8), bool(flags & 16))
+        self.en_passant = divmod(en_passant, 8) if en_passant != no_square else ()
+        self.white_king = divmod(white_king, 8)
+        self.black_king = divmod(black_king, 8)
+        self._start_logs(halfmove_clock)
+
+    def _start_logs(self, halfmove_clock):
+        self.moveLog = []
+        self.en_passant_log = [self.en_passant]
+        self.castle_log = [Castle(self.castling_ability.wks, self.castling_ability.wqs,
+                                  self.castling_ability.bks, self.castling_ability.bqs)]
+        self.checkmate = False
+        self.stalemate = False
+        self.piece_locations = self.find_pieces()
+        self.key = self.compute_key()
+        self.key_log = [self.key]
+        self.halfmove_clock = halfmove_clock
+        self.halfmove_log = [self.halfmove_clock]
+
+    def find_pieces(self):
+        # Squares of every piece by color and type, make_move and undo_move keep these up to date
+        piece_locations = {piece: set() for piece in zobrist_pieces}
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c] != "--":
+                    piece_locations[self.board[r][c]].add((r, c))
+        return piece_locations
+
+    def compute_key(self):
+        # Full Zobrist hash of the position, make_move keeps self.key up to date incrementally
+        key = 0
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c] != "--":
+                    key ^= zobrist_pieces[self.board[r][c]][r][c]
+        if not self.whiteToMove:
+            key ^= zobrist_black_to_move
+        key ^= zobrist_castling[self.castling_ability.index()]
+        if self.en_passant != ():
+            key ^= zobrist_en_passant[self.en_passant[1]]
+        return key
+
     def make_move(self, move):
         if self.board[move.start_row][move.start_col] != "--":
+            key = self.key ^ zobrist_castling[self.castling_ability.index()] ^ zobrist_black_to_move
+            if self.en_passant != ():
+                key ^= zobrist_en_passant[self.en_passant[1]]
+
             self.board[move.start_row][move.start_col] = "--"
             self.board[move.end_row][move.end_col] = move.piece_moved
             self.moveLog.append(move)
@@ -71,6 +245,50 @@ class GameState:
             self.castle_log.append(Castle(self.castling_ability.wks, self.castling_ability.wqs,
                                           self.castling_ability.bks, self.castling_ability.bqs))
 
+            # Update the position hash
+            key ^= zobrist_pieces[move.piece_moved][move.start_row][move.start_col]
+            key ^= zobrist_pieces[self.board[move.end_row][move.end_col]][move.end_row][move.end_col]
+            if move.en_passant_move:
+                key ^= zobrist_pieces[move.piece_captured][move.start_row][move.end_col]
+            elif move.piece_captured != "--":
+                key ^= zobrist_pieces[move.piece_captured][move.end_row][move.end_col]
+            if move.castle_move:
+                rook = move.piece_moved[0] + 'R'
+                if move.end_col - move.start_col == 2:  # King side
+                    key ^= zobrist_pieces[rook][move.end_row][move.end_col+1] ^ \
+                        zobrist_pieces[rook][move.end_row][move.end_col-1]
+                else:  # Queen side
+                    key ^= zobrist_pieces[rook][move.end_row][move.end_col-2] ^ \
+                        zobrist_pieces[rook][move.end_row][move.end_col+1]
+            key ^= zobrist_castling[self.castling_ability.index()]
+            if self.en_passant != ():
+                key ^= zobrist_en_passant[self.en_passant[1]]
+            self.key = key
+            self.key_log.append(key)
+
+            # Update the piece locations
+            self.piece_locations[move.piece_moved].discard((move.start_row, move.start_col))
+            if move.en_passant_move:
+                self.piece_locations[move.piece_captured].discard((move.start_row, move.end_col))
+            elif move.piece_captured != "--":
+                self.piece_locations[move.piece_captured].discard((move.end_row, move.end_col))
+            self.piece_locations[self.board[move.end_row][move.end_col]].add((move.end_row, move.end_col))
+            if move.castle_move:
+                rooks = self.piece_locations[move.piece_moved[0] + 'R']
+                if move.end_col - move.start_col == 2:  # King side
+                    rooks.discard((move.end_row, move.end_col+1))
+                    rooks.add((move.end_row, move.end_col-1))
+                else:  # Queen side
+                    rooks.discard((move.end_row, move.end_col-2))
+                    rooks.add((move.end_row, move.end_col+1))
+
+            # Moves since the last capture or pawn move, for the fifty move rule
+            if move.piece_moved[1] == 'P' or move.piece_captured != "--":
+                self.halfmove_clock = 0
+            else:
+                self.halfmove_clock += 1
+            self.halfmove_log.append(self.halfmove_clock)
+
     def update_castle_rights(self, move):
         # King move
         if move.piece_captured == 'wR':
@@ -123,6 +341,13 @@ class GameState:
     def undo_move(self):
         if len(self.moveLog) != 0:
             move = self.moveLog.pop()
+            self.piece_locations[self.board[move.end_row][move.end_col]].discard((move.end_row, move.end_col))
+            self.piece_locations[move.piece_moved].add((move.start_row, move.start_col))
+            if move.en_passant_move:
+                self.piece_locations[move.piece_captured].add((move.start_row, move.end_col))
+            elif move.piece_captured != "--":
+                self.piece_locations[move.piece_captured].add((move.end_row, move.end_col))
+
             self.board[move.start_row][move.start_col] = move.piece_moved
             self.board[move.end_row][move.end_col] = move.piece_captured
             self.whiteToMove = not self.whiteToMove
@@ -145,18 +370,50 @@ class GameState:
             self.castling_ability.bks = self.castle_log[-1].bks
             self.castling_ability.bqs = self.castle_log[-1].bqs
 
+            self.key_log.pop()
+            self.key = self.key_log[-1]
+            self.halfmove_log.pop()
+            self.halfmove_clock = self.halfmove_log[-1]
+
             if move.castle_move:
+                rooks = self.piece_locations[move.piece_moved[0] + 'R']
                 if move.end_col - move.start_col == 2:  # King side
                     self.board[move.end_row][move.end_col+1] = self.board[move.end_row][move.end_col-1]
                     self.board[move.end_row][move.end_col-1] = '--'
+                    rooks.discard((move.end_row, move.end_col-1))
+                    rooks.add((move.end_row, move.end_col+1))
                 else:
                     self.board[move.end_row][move.end_col-2] = self.board[move.end_row][move.end_col+1]
                     self.board[move.end_row][move.end_col+1] = '--'
+                    rooks.discard((move.end_row, move.end_col+1))
+                    rooks.add((move.end_row, move.end_col-2))
 
             self.checkmate = False
             self.stalemate = False
 
+    def repetition_count(self, since=0):
+        # Earlier occurrences of the current position from ply since onwards, a capture or pawn move can't be undone
+        # so only positions after the last one are checked
+        count = 0
+        last = len(self.key_log) - 1
+        first = max(last - self.halfmove_clock, since)
+        for i in range(last - 2, first - 1, -2):
+            if self.key_log[i] == self.key:
+                count += 1
+        return count
+
+    def is_threefold_repetition(self):
+        return self.repetition_count() >= 2
+
+    def is_fifty_move_draw(self):
+        return self.halfmove_clock >= 100
+
     def get_valid_moves(self):
+        cached = self.move_cache.get(self.key)
+        if cached is not None:
+            moves, self.checkmate, self.stalemate = cached
+            return list(moves)
+
         temp_en_passant_possible = self.en_passant
         temp_castling_ability = Castle(self.castling_ability.wks, self.castling_ability.wqs,
                                        self.castling_ability.bks, self.castling_ability.bqs)
@@ -182,11 +439,12 @@ class GameState:
                 self.stalemate = True
         else:
             self.checkmate = False
-            self.checkmate = False
+            self.stalemate = False
 
         self.en_passant = temp_en_passant_possible
         self.castling_ability = temp_castling_ability
-        return moves
+        self.move_cache.put(self.key, moves, self.checkmate, self.stalemate)
+        return list(moves)
 
     def in_check(self):
         if self.whiteToMove:
@@ -206,11 +464,10 @@ class GameState:
 
     def get_all_possible_moves(self):
         moves = []
-        for r in range(len(self.board)):
-            for c in range(len(self.board[r])):
-                turn, piece = self.board[r][c][0], self.board[r][c][1]
-                if (turn == 'w' and self.whiteToMove) or (turn == 'b' and not self.whiteToMove):
-                    self.move_functions[piece](r, c, moves)
+        turn = 'w' if self.whiteToMove else 'b'
+        for piece in 'PNBRQK':
+            for r, c in self.piece_locations[turn + piece]:
+                self.move_functions[piece](r, c, moves)
 
         return moves
 
@@ -339,6 +596,12 @@ class GameState:
                 moves.append(Move((r, c), (r, c-2), self.board, castle_move=True))
 
 
+def unpack(data, offset=0):
+    gs = GameState()
+    gs.load_snapshot(data, offset)
+    return gs
+
+
 class Move:
     rank_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4, "5": 3, "6": 2, "7": 1, "8": 0}
     rows_to_ranks = {v: k for k, v in rank_to_rows.items()}
@@ -391,6 +654,13 @@ class Move:
 
         return notation
 
+    def get_uci_notation(self):
+        # Long algebraic form used by UCI, promotions are always to a queen
+        notation = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        if self.pawn_promotion:
+            notation += 'q'
+        return notation
+
     def get_rank_file(self, row, col):
         return self.cols_to_files[col] + self.rows_to_ranks[row]
 
@@ -400,4 +670,43 @@ class Castle:
         self.wks = wks
         self.wqs = wqs
         self.bks = bks
-        self.bqs = bqs
\ No newline at end of file
+        self.bqs = bqs
+
+    def index(self):
+        return self.wks | self.wqs << 1 | self.bks << 2 | self.bqs << 3
+
+
+class MoveCache:
+    """
+    Least recently used store of legal move lists and checkmate/stalemate flags keyed by the position hash,
+    holds at most max_entries positions
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, moves, checkmate, stalemate):
+        self.entries[key] = (moves, checkmate, stalemate)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
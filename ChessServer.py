@@ -0,0 +1,331 @@
+"""
+Local analysis service, answers best move and evaluation requests for FEN positions from a pool of engine processes.
+Requests and responses are single lines of JSON over TCP:
+    {"id": 1, "op": "move", "fen": "...", "depth": 3, "movetime": 500, "timeout": 5}
+    {"id": 2, "op": "eval", "fen": "..."}
+    {"id": 3, "op": "stats"}
+Scores are in centipawns from the point of view of the side to move, checkmate is +-100000. Invalid FENs get
+{"error": "invalid fen"}
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import ChessEngine
+import ChessAI
+
+
+default_host = "127.0.0.1"
+default_port = 8765
+default_timeout = 10.0  # seconds, covers waiting in the queue and the search itself
+response_margin = 0.05  # seconds of the timeout left for sending the result back
+max_queue = 64
+batch_size = 32
+batch_wait = 0.005  # seconds to wait for more evaluations to join a batch
+max_search_depth = 64
+latency_samples = 1000
+
+
+'''
+Worker processes, each keeps one warm GameState so its move cache carries over between requests
+'''
+
+
+def warm_worker():
+    global worker_gs
+    worker_gs = ChessEngine.GameState()
+    worker_gs.get_valid_moves()
+
+
+def worker_ready():
+    return os.getpid()
+
+
+def counted(function, *args):
+    # Runs a worker function and returns its result with this worker's move cache counters
+    return function(*args), (os.getpid(), worker_gs.move_cache.hits, worker_gs.move_cache.misses)
+
+
+def side_to_move_score(gs):
+    # score_board is from white's point of view
+    return round(ChessAI.score_board(gs) * (100 if gs.whiteToMove else -100))
+
+
+def analyse_position(fen, depth_limit, time_limit):
+    try:
+        worker_gs.load_fen(fen)
+    except ValueError:
+        return {"error": "invalid fen"}
+    try:
+        return search_position(depth_limit, time_limit)
+    except Exception:
+        # The half searched position may have left bad entries in the warm cache
+        worker_gs.move_cache.clear()
+        return {"error": "analysis failed"}
+
+
+def search_position(depth_limit, time_limit):
+    valid_moves = worker_gs.get_valid_moves()
+    if len(valid_moves) == 0:
+        return {"bestmove": None, "score": side_to_move_score(worker_gs), "depth": 0, "nodes": 0, "pv": []}
+
+    iterations = []
+    best_move, pv = ChessAI.iterative_deepening(worker_gs, valid_moves, depth_limit, time_limit,
+                                                on_iteration=lambda *info: iterations.append(info))
+    depth, score, nodes = iterations[-1][:3] if len(iterations) > 0 else (0, 0, ChessAI.nodes)
+    return {"bestmove": best_move.get_uci_notation(), "score": round(score * 100), "depth": depth,
+            "nodes": nodes, "pv": [move.get_uci_notation() for move in pv]}
+
+
+def evaluate_positions(fens):
+    # Static evaluation of each position, one result per position so a bad one doesn't fail the rest of the batch
+    results = []
+    for fen in fens:
+        try:
+            worker_gs.load_fen(fen)
+        except ValueError:
+            results.append({"error": "invalid fen"})
+            continue
+        try:
+            worker_gs.get_valid_moves()
+            results.append({"score": side_to_move_score(worker_gs), "checkmate": worker_gs.checkmate,
+                            "stalemate": worker_gs.stalemate})
+        except Exception:
+            worker_gs.move_cache.clear()
+            results.append({"error": "evaluation failed"})
+    return results
+
+
+'''
+Server
+'''
+
+
+class Job:
+    def __init__(self, request, deadline):
+        self.request = request
+        self.deadline = deadline
+        self.received = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class AnalysisServer:
+    def __init__(self, workers=None, queue_size=max_queue):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.search_queue = asyncio.Queue(queue_size)
+        self.eval_queue = asyncio.Queue(queue_size)
+        # Limits work handed to the pool so requests wait in our queues where they can be counted and expired
+        self.slots = asyncio.Semaphore(self.workers)
+        self.tasks = []
+        self.latencies = deque(maxlen=latency_samples)
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.failed = 0
+        self.restarts = 0
+        self.cache_counts = {}  # worker pid -> latest move cache hits and misses
+
+    async def start(self, host=default_host, port=default_port):
+        loop = asyncio.get_running_loop()
+        self.pool = ProcessPoolExecutor(self.workers, initializer=warm_worker)
+        # Start every worker up front so the first requests don't pay for it
+        await asyncio.gather(*[loop.run_in_executor(self.pool, worker_ready) for i in range(self.workers)])
+        self.tasks = [asyncio.create_task(self.search_dispatcher()) for i in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.eval_batcher()))
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def replace_pool(self, broken):
+        # A worker dying breaks the whole pool for good, start a new one unless another task already has
+        if self.pool is broken:
+            self.restarts += 1
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = ProcessPoolExecutor(self.workers, initializer=warm_worker)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.pool.shutdown(cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self.respond(line, writer, write_lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            await asyncio.gather(*pending, return_exceptions=True)
+            writer.close()
+
+    async def respond(self, line, writer, write_lock):
+        request = None
+        try:
+            request = json.loads(line)
+            response = await self.handle_request(request)
+        except (ValueError, TypeError, AttributeError):
+            response = {"error": "invalid request"}
+        # Responses can come back out of order, the id lets the client match even an error to its request
+        if isinstance(request, dict):
+            response["id"] = request.get("id")
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    async def handle_request(self, request):
+        op = request.get("op")
+        if op == "stats":
+            return self.stats()
+        if op not in ("move", "eval") or not isinstance(request.get("fen"), str):
+            return {"error": "invalid request"}
+
+        timeout = float(request.get("timeout", default_timeout))
+        job = Job(request, time.monotonic() + timeout)
+        queue = self.search_queue if op == "move" else self.eval_queue
+        # Shed load instead of letting the queue grow without bound
+        if queue.full():
+            self.rejected += 1
+            return {"error": "busy"}
+        queue.put_nowait(job)
+
+        try:
+            result = await asyncio.wait_for(job.future, timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return {"error": "timeout"}
+
+        self.completed += 1
+        self.latencies.append(time.monotonic() - job.received)
+        return result
+
+    async def search_dispatcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.search_queue.get()
+            async with self.slots:
+                remaining = job.deadline - time.monotonic()
+                if job.future.done() or remaining <= 0:
+                    continue
+                request = job.request
+                try:
+                    # The search stops itself just before the deadline, a process can't be interrupted from outside
+                    time_limit = max(remaining - response_margin, 0.01)
+                    if "movetime" in request:
+                        time_limit = min(time_limit, request["movetime"] / 1000)
+                    depth_limit = int(request.get("depth", max_search_depth if "movetime" in request
+                                                  else ChessAI.max_depth))
+                except (ValueError, KeyError, TypeError):
+                    result = {"error": "invalid request"}
+                else:
+                    # Anything raised by the pool, such as a worker dying, fails this job but keeps the dispatcher
+                    pool = self.pool
+                    try:
+                        result = await loop.run_in_executor(pool, counted, analyse_position, request["fen"],
+                                                            depth_limit, time_limit)
+                        result = self.count_cache(result)
+                    except Exception as error:
+                        if isinstance(error, BrokenProcessPool):
+                            self.replace_pool(pool)
+                        self.failed += 1
+                        result = {"error": "analysis failed"}
+                if not job.future.done():
+                    job.future.set_result(result)
+
+    async def eval_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.eval_queue.get()]
+            batch_deadline = time.monotonic() + batch_wait
+            while len(jobs) < batch_size:
+                remaining = batch_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(await asyncio.wait_for(self.eval_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            now = time.monotonic()
+            jobs = [job for job in jobs if not job.future.done() and job.deadline > now]
+            if len(jobs) == 0:
+                continue
+            await self.slots.acquire()
+            pool = self.pool
+            try:
+                task = loop.run_in_executor(pool, counted, evaluate_positions, [job.request["fen"] for job in jobs])
+            except Exception as error:
+                # A broken pool refuses new work straight away
+                task = loop.create_future()
+                task.set_exception(error)
+            task.add_done_callback(lambda done, batch=jobs: self.finish_batch(done, batch, pool))
+
+    def finish_batch(self, done, jobs, pool):
+        self.slots.release()
+        if not done.cancelled() and done.exception() is None:
+            results = self.count_cache(done.result())
+        else:
+            if not done.cancelled() and isinstance(done.exception(), BrokenProcessPool):
+                self.replace_pool(pool)
+            self.failed += 1
+            results = [{"error": "evaluation failed"}] * len(jobs)
+        for job, result in zip(jobs, results):
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def count_cache(self, counted_result):
+        result, (pid, hits, misses) = counted_result
+        self.cache_counts[pid] = (hits, misses)
+        return result
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        hits = sum(counts[0] for counts in self.cache_counts.values())
+        misses = sum(counts[1] for counts in self.cache_counts.values())
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return None
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 3)
+
+        return {"search_queue": self.search_queue.qsize(), "eval_queue": self.eval_queue.qsize(),
+                "completed": self.completed, "rejected": self.rejected, "timed_out": self.timed_out,
+                "failed": self.failed, "restarts": self.restarts,
+                "move_cache": {"hits": hits, "misses": misses,
+                               "hit_rate": round(hits / (hits + misses), 3) if hits + misses > 0 else 0.0},
+                "latency_ms": {"p50": percentile(.5), "p90": percentile(.9), "p99": percentile(.99)}}
+
+
+async def serve(host, port, workers):
+    server = AnalysisServer(workers)
+    listener = await server.start(host, port)
+    print("analysis server listening on %s:%d with %d workers" % (host, port, server.workers))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local chess analysis server")
+    parser.add_argument("--host", default=default_host)
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--workers", type=int, default=None, help="engine processes, defaults to the cpu count")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Ring of packed positions in shared memory, lets parallel search and batch analysis hand positions to worker
+processes by generation number instead of pickling whole GameState objects
+"""
+import struct
+from multiprocessing import shared_memory
+import ChessEngine
+
+
+attached_rings = {}
+# Each slot starts with the generation of the snapshot in it, the number of puts made before it
+generation_format = struct.Struct("<Q")
+slot_size = generation_format.size + ChessEngine.snapshot_size
+being_written = 2 ** 64 - 1
+
+
+class SnapshotOverwritten(Exception):
+    pass
+
+
+class SnapshotRing:
+    """
+    slots fixed size snapshots from GameState.pack. The creating process owns the memory and unlinks it on close,
+    workers attach with the ring's name and the same number of slots.
+    put returns a generation number which is passed to read. Slots are reused in turn, so a snapshot can only be
+    read until slots more puts have been made, after that read raises SnapshotOverwritten instead of loading the
+    position that replaced it. Keep fewer than slots snapshots in flight
+    """
+    def __init__(self, slots, name=None):
+        self.slots = slots
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+            for slot in range(slots):
+                generation_format.pack_into(self.memory.buf, slot * slot_size, being_written)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.next_generation = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def put(self, gs):
+        # Write to the next slot in turn, overwriting the oldest snapshot, and return its generation
+        generation = self.next_generation
+        offset = (generation % self.slots) * slot_size
+        # Mark the slot while it is written so a late reader of the old snapshot can't get half of each
+        generation_format.pack_into(self.memory.buf, offset, being_written)
+        start = offset + generation_format.size
+        self.memory.buf[start:start + ChessEngine.snapshot_size] = gs.pack()
+        generation_format.pack_into(self.memory.buf, offset, generation)
+        self.next_generation = generation + 1
+        return generation
+
+    def read(self, generation, gs=None):
+        # Load the snapshot into gs, keeping its move cache, or into a new GameState
+        offset = (generation % self.slots) * slot_size
+        self._check_generation(offset, generation)
+        if gs is None:
+            gs = ChessEngine.unpack(self.memory.buf, offset + generation_format.size)
+        else:
+            gs.load_snapshot(self.memory.buf, offset + generation_format.size)
+        # The slot may have been reused while it was being read
+        self._check_generation(offset, generation)
+        return gs
+
+    def _check_generation(self, offset, generation):
+        if generation_format.unpack_from(self.memory.buf, offset)[0] != generation:
+            raise SnapshotOverwritten("snapshot %d is no longer in the ring" % generation)
+
+    def close(self):
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def attach(name, slots):
+    # Workers call this for every task, the ring is only mapped the first time
+    if name not in attached_rings:
+        attached_rings[name] = SnapshotRing(slots, name)
+    return attached_rings[name]
@@ -0,0 +1,206 @@
+"""
+Headless driver, speaks the UCI protocol over stdin/stdout so the engine can run under tournament managers
+"""
+import sys
+import threading
+import ChessEngine
+import ChessAI
+
+
+engine_name = "Chess"
+engine_author = "Alaric Hunziker"
+start_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+max_search_depth = 64
+default_moves_to_go = 30
+move_overhead = 0.05  # seconds kept back for communication with the GUI
+
+
+'''
+Time management
+'''
+
+
+def allocate_time(time_left, increment=0, moves_to_go=None):
+    # Spread the remaining clock over the moves left to the next time control and use most of the increment
+    moves_to_go = moves_to_go if moves_to_go else default_moves_to_go
+    budget = time_left / moves_to_go + increment * 0.75
+    budget = min(budget, time_left * 0.5)
+    return max(budget - move_overhead, 0.01)
+
+
+def format_score(score, pv):
+    # Mate scores aren't adjusted for distance, the principal variation ends with the mating move
+    if score >= ChessAI.checkmate:
+        return "mate %d" % ((len(pv) + 1) // 2)
+    if score <= -ChessAI.checkmate:
+        return "mate %d" % -(len(pv) // 2)
+    return "cp %d" % round(score * 100)
+
+
+def parse_move(gs, valid_moves, text):
+    # None for anything that isn't a legal move in the position, the engine can only promote to a queen
+    files, ranks = ChessEngine.Move.files_to_col, ChessEngine.Move.rank_to_rows
+    if len(text) not in (4, 5) or text[0] not in files or text[1] not in ranks or text[2] not in files or \
+            text[3] not in ranks:
+        return None
+    start_square = (ChessEngine.Move.rank_to_rows[text[1]], ChessEngine.Move.files_to_col[text[0]])
+    end_square = (ChessEngine.Move.rank_to_rows[text[3]], ChessEngine.Move.files_to_col[text[2]])
+    move = ChessEngine.Move(start_square, end_square, gs.board)
+    for valid_move in valid_moves:
+        if move == valid_move:
+            if len(text) == 5 and (text[4] != 'q' or not valid_move.pawn_promotion):
+                return None
+            return valid_move
+    return None
+
+
+'''
+Protocol handling
+'''
+
+
+class UCIEngine:
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.gs = ChessEngine.GameState()
+        self.valid_moves = self.gs.get_valid_moves()
+        self.search_thread = None
+        self.stop_event = threading.Event()
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def handle(self, line):
+        # Returns False once the GUI asks the engine to quit
+        tokens = line.split()
+        if len(tokens) == 0:
+            return True
+        command = tokens[0]
+
+        if command == "uci":
+            self.send("id name " + engine_name)
+            self.send("id author " + engine_author)
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self.stop()
+            move_cache = self.gs.move_cache
+            self.gs = ChessEngine.GameState()
+            self.gs.move_cache = move_cache
+            self.valid_moves = self.gs.get_valid_moves()
+        elif command == "position":
+            self.stop()
+            self.position(tokens[1:])
+        elif command == "go":
+            self.stop()
+            self.go(tokens[1:])
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            return False
+        return True
+
+    def position(self, tokens):
+        if len(tokens) == 0:
+            return
+        if tokens[0] == "startpos":
+            fen = start_fen
+            tokens = tokens[1:]
+        elif tokens[0] == "fen":
+            end = tokens.index("moves") if "moves" in tokens else len(tokens)
+            fen = " ".join(tokens[1:end])
+            tokens = tokens[end:]
+        else:
+            return
+
+        # Set up the new position on its own so a FEN that can't be played leaves the current one in place. The move
+        # cache is keyed by position so it carries over, a GUI sends the whole game again before every move
+        gs = ChessEngine.GameState()
+        gs.move_cache = self.gs.move_cache
+        try:
+            gs.load_fen(fen)
+            valid_moves = gs.get_valid_moves()
+        except (ValueError, KeyError, IndexError):
+            self.send("info string invalid fen " + fen)
+            return
+        self.gs = gs
+        self.valid_moves = valid_moves
+        if len(tokens) > 0 and tokens[0] == "moves":
+            for text in tokens[1:]:
+                move = parse_move(self.gs, self.valid_moves, text)
+                if move is None:
+                    self.send("info string illegal move " + text)
+                    break
+                self.gs.make_move(move)
+                self.valid_moves = self.gs.get_valid_moves()
+
+    def go(self, tokens):
+        limits = {}
+        i = 0
+        while i < len(tokens):
+            if tokens[i] == "infinite":
+                limits["infinite"] = True
+                i += 1
+            elif i + 1 < len(tokens) and tokens[i + 1].lstrip('-').isdigit():
+                limits[tokens[i]] = int(tokens[i + 1])
+                i += 2
+            else:
+                i += 1
+
+        depth_limit = limits.get("depth", max_search_depth)
+        time_limit = None
+        if "movetime" in limits:
+            time_limit = max(limits["movetime"] / 1000 - move_overhead, 0.01)
+        elif not limits.get("infinite"):
+            time_left = limits.get("wtime") if self.gs.whiteToMove else limits.get("btime")
+            increment = limits.get("winc", 0) if self.gs.whiteToMove else limits.get("binc", 0)
+            if time_left is not None:
+                time_limit = allocate_time(time_left / 1000, increment / 1000, limits.get("movestogo"))
+            elif "depth" not in limits:
+                depth_limit = ChessAI.max_depth
+
+        self.stop_event = threading.Event()
+        self.search_thread = threading.Thread(target=self.search, daemon=True,
+                                              args=(depth_limit, time_limit, self.stop_event,
+                                                    limits.get("infinite", False)))
+        self.search_thread.start()
+
+    def search(self, depth_limit, time_limit, stop_event, infinite):
+        best_move, pv = ChessAI.iterative_deepening(self.gs, self.valid_moves, depth_limit, time_limit, stop_event,
+                                                    self.report_iteration)
+        cache = self.gs.move_cache
+        self.send("info string move cache hits %d misses %d hit rate %.1f%%" %
+                  (cache.hits, cache.misses, cache.hit_rate() * 100))
+        # The search can finish early on a mate or a forced move, but under go infinite the GUI decides when to stop
+        if infinite:
+            stop_event.wait()
+        self.send("bestmove " + (best_move.get_uci_notation() if best_move is not None else "0000"))
+
+    def report_iteration(self, depth, score, nodes, elapsed, pv):
+        nps = int(nodes / elapsed) if elapsed > 0 else 0
+        self.send("info depth %d score %s nodes %d nps %d time %d pv %s" %
+                  (depth, format_score(score, pv), nodes, nps, int(elapsed * 1000),
+                   " ".join(move.get_uci_notation() for move in pv)))
+
+    def stop(self):
+        if self.search_thread is not None:
+            self.stop_event.set()
+            self.search_thread.join()
+            self.search_thread = None
+
+
+def main():
+    engine = UCIEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+    engine.stop()
+
+
+if __name__ == "__main__":
+    main()